@@ -56,9 +56,14 @@ from flask_security import (
     permissions_required,
     uia_email_mapper,
 )
+from flask_security.signals import password_reset, reset_password_instructions_sent
 from flask_security.utils import localize_callback
 
-from tests.test_utils import convert_bool_option, populate_data
+from tests.test_utils import (
+    capture_reset_password_requests,
+    convert_bool_option,
+    populate_data,
+)
 
 NO_BABEL = False
 try:
@@ -115,6 +120,9 @@ def app(request):
     # assert not find_sqlite_connections()  # hopefully find tests that don't clean up
     app = Flask(__name__)
     app.response_class = Response
+    # Must precede setting debug - which would otherwise turn on template
+    # auto-reload (a stat() per render).
+    app.config["TEMPLATES_AUTO_RELOAD"] = False
     app.debug = True
     app.config["SECRET_KEY"] = "secret"
     app.config["TESTING"] = True
@@ -1013,6 +1021,38 @@ def clients(request, app, tmpdir, realdburl, realmongodburl):
     td()
 
 
+@pytest.fixture()
+def joe_reset_token(app, client):
+    # Request a password reset for joe and return (user, token) - for tests
+    # that just need a valid token and don't care about the /reset request itself.
+    with capture_reset_password_requests() as requests:
+        client.post(app.config["SECURITY_RESET_URL"], data=dict(email="joe@lp.com"))
+    return requests[0]["user"], requests[0]["token"]
+
+
+@pytest.fixture()
+def reset_signal_recorder(app):
+    # Record password_reset and reset_password_instructions_sent signals for
+    # the duration of a test - returns (reset users, instructions sent users).
+    recorded_resets = []
+    recorded_instructions_sent = []
+
+    def on_password_reset(app, user):
+        recorded_resets.append(user)
+
+    def on_instructions_sent(app, **kwargs):
+        assert isinstance(app, Flask)
+        assert isinstance(kwargs["user"], UserMixin)
+        assert isinstance(kwargs["token"], str)
+        recorded_instructions_sent.append(kwargs["user"])
+
+    password_reset.connect(on_password_reset, app)
+    reset_password_instructions_sent.connect(on_instructions_sent, app)
+    yield recorded_resets, recorded_instructions_sent
+    password_reset.disconnect(on_password_reset, app)
+    reset_password_instructions_sent.disconnect(on_instructions_sent, app)
+
+
 @pytest.fixture()
 def in_app_context(request, app, sqlalchemy_datastore):
     app.security = Security(
@@ -8,62 +8,77 @@ Recoverable functionality tests
 :license: MIT, see LICENSE for more details.
 """
 
-from datetime import date, timedelta
 import re
-from urllib.parse import parse_qsl, urlsplit
+import time
+from urllib.parse import unquote_plus
 
 import pytest
-from flask import Flask
-from freezegun import freeze_time
+from flask import session
+from flask_wtf.csrf import generate_csrf
+from itsdangerous import TimestampSigner
 from wtforms.fields import StringField
 from wtforms.validators import Length
 from tests.test_utils import (
     authenticate,
     capture_flashes,
     capture_reset_password_requests,
+    capture_username_recovery_requests,
     check_location,
     get_form_input_value,
+    init_app_with_options,
     is_authenticated,
     logout,
-    populate_data,
+    read_flashes,
 )
 
-from flask_security.core import Security, UserMixin
+from flask_security.core import UserMixin
 from flask_security.forms import ForgotPasswordForm, LoginForm
-from flask_security.signals import (
-    password_reset,
-    reset_password_instructions_sent,
-    username_recovery_email_sent,
-)
+from flask_security.signals import password_reset, reset_password_instructions_sent
 
 pytestmark = pytest.mark.recoverable()
 
+_EMAIL_INPUT_RE = re.compile(rb'<input[^>]*type="email"[^>]*>')
+_KV_RE = re.compile(r"\w+:.*", re.IGNORECASE)
+_SPA_LOCATION_RE = re.compile(
+    r"^(?:\w+:)?//(?P<host>[^/?]+)(?P<path>[^?]*)(?:\?(?P<query>.*))?$"
+)
 
-def test_recoverable_flag(app, clients, get_message, outbox):
-    recorded_resets = []
-    recorded_instructions_sent = []
+# A well-formed looking but invalid reset token
+_MANGLED_TOKEN = (
+    "WyIxNjQ2MzYiLCIxMzQ1YzBlZmVhM2VhZjYwODgwMDhhZGU2YzU0MzZjMiJd."
+    "BZEw_Q.lQyo3npdPZtcJ_sNHVHP103syjM"
+    "&url_id=fbb89a8328e58c181ea7d064c2987874bc54a23d"
+)
 
-    @password_reset.connect_via(app)
-    def on_password_reset(app, user):
-        recorded_resets.append(user)
 
-    @reset_password_instructions_sent.connect_via(app)
-    def on_instructions_sent(app, **kwargs):
-        assert isinstance(app, Flask)
-        assert isinstance(kwargs["user"], UserMixin)
-        assert isinstance(kwargs["token"], str)
-        recorded_instructions_sent.append(kwargs["user"])
+def _split_spa_location(location):
+    # Return (host, path, query params) of a SPA redirect location.
+    m = _SPA_LOCATION_RE.match(location)
+    assert m
+    qparams = {}
+    if m["query"]:
+        for kv in m["query"].split("&"):
+            k, _, v = kv.partition("=")
+            qparams[unquote_plus(k)] = unquote_plus(v)
+    return m["host"], m["path"], qparams
+
+
+def _yesterday_timestamp(signer):
+    # Replacement for TimestampSigner.get_timestamp to create already expired tokens.
+    return int(time.time()) - 24 * 60 * 60
+
+
+def test_recoverable_flag(app, clients, get_message, outbox, reset_signal_recorder):
+    recorded_resets, recorded_instructions_sent = reset_signal_recorder
 
     # Test the reset view
     response = clients.get("/reset")
     assert b"<h1>Send password reset instructions</h1>" in response.data
-    assert re.search(b'<input[^>]*type="email"[^>]*>', response.data)
+    assert _EMAIL_INPUT_RE.search(response.data)
 
     # Test submitting email to reset password creates a token and sends email
     with capture_reset_password_requests() as requests:
-        response = clients.post(
-            "/reset", data=dict(email="joe@lp.com"), follow_redirects=True
-        )
+        response = clients.post("/reset", data=dict(email="joe@lp.com"))
 
     assert len(recorded_instructions_sent) == 1
     assert len(outbox) == 1
@@ -76,61 +91,33 @@ def test_recoverable_flag(app, clients, get_message, outbox):
     assert b"<h1>Reset password</h1>" in response.data
 
     # Test submitting a new password but leave out confirm
-    response = clients.post(
-        "/reset/" + token, data={"password": "newpassword"}, follow_redirects=True
-    )
+    response = clients.post("/reset/" + token, data={"password": "newpassword"})
     assert get_message("PASSWORD_NOT_PROVIDED") in response.data
     assert len(recorded_resets) == 0
 
     # Test submitting a new password
-    response = clients.post(
-        "/reset/" + token,
-        data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
-        follow_redirects=True,
-    )
-
-    assert get_message("PASSWORD_RESET_NO_LOGIN") in response.data
+    with capture_flashes() as flashes:
+        response = clients.post(
+            "/reset/" + token,
+            data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
+        )
+    assert check_location(app, response.location, "/login")
+    msg = get_message("PASSWORD_RESET_NO_LOGIN").decode("utf-8")
+    assert [f["message"] for f in flashes] == [msg]
     assert len(recorded_resets) == 1
 
     logout(clients)
 
     # Test logging in with the new password
-    response = authenticate(
-        clients, "joe@lp.com", "awesome sunset", follow_redirects=True
-    )
-    assert b"Welcome joe@lp.com" in response.data
+    authenticate(clients, "joe@lp.com", "awesome sunset")
+    assert is_authenticated(clients, get_message)
 
     logout(clients)
 
     # Test invalid email
-    response = clients.post(
-        "/reset", data=dict(email="bogus@lp.com"), follow_redirects=True
-    )
+    response = clients.post("/reset", data=dict(email="bogus@lp.com"))
     assert get_message("USER_DOES_NOT_EXIST") in response.data
 
-    logout(clients)
-
-    # Test invalid token
-    response = clients.post(
-        "/reset/bogus",
-        data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
-        follow_redirects=True,
-    )
-    assert get_message("INVALID_RESET_PASSWORD_TOKEN") in response.data
-
-    # Test mangled token
-    token = (
-        "WyIxNjQ2MzYiLCIxMzQ1YzBlZmVhM2VhZjYwODgwMDhhZGU2YzU0MzZjMiJd."
-        "BZEw_Q.lQyo3npdPZtcJ_sNHVHP103syjM"
-        "&url_id=fbb89a8328e58c181ea7d064c2987874bc54a23d"
-    )
-    response = clients.post(
-        "/reset/" + token,
-        data={"password": "newpassword", "password_confirm": "newpassword"},
-        follow_redirects=True,
-    )
-    assert get_message("INVALID_RESET_PASSWORD_TOKEN") in response.data
-
 
 @pytest.mark.confirmable()
 @pytest.mark.registerable()
@@ -141,40 +128,28 @@ def test_requires_confirmation_error_redirect(app, clients):
     )
     clients.post("/register", data=data)
 
-    response = clients.post(
-        "/reset", data=dict(email="jyl@lp.com"), follow_redirects=True
-    )
+    response = clients.post("/reset", data=dict(email="jyl@lp.com"))
+    assert response.status_code == 302
+    response = clients.get(response.location)
     assert b"send_confirmation_form" in response.data
     assert b"jyl@lp.com" in response.data
 
 
 @pytest.mark.settings()
-def test_recoverable_json(app, client, get_message, outbox):
-    recorded_resets = []
-    recorded_instructions_sent = []
-
-    @password_reset.connect_via(app)
-    def on_password_reset(app, user):
-        recorded_resets.append(user)
-
-    @reset_password_instructions_sent.connect_via(app)
-    def on_instructions_sent(app, **kwargs):
-        recorded_instructions_sent.append(kwargs["user"])
+def test_recoverable_json(app, client, get_message, outbox, reset_signal_recorder):
+    recorded_resets, recorded_instructions_sent = reset_signal_recorder
 
-    with capture_flashes() as flashes:
+    with capture_flashes() as flashes, capture_reset_password_requests() as requests:
         # Test reset password creates a token and sends email
-        with capture_reset_password_requests() as requests:
-            response = client.post(
-                "/reset",
-                json=dict(email="joe@lp.com"),
-                headers={"Content-Type": "application/json"},
-            )
-            assert response.headers["Content-Type"] == "application/json"
-
+        response = client.post(
+            "/reset",
+            json=dict(email="joe@lp.com"),
+        )
+        assert response.headers["Content-Type"] == "application/json"
         assert len(recorded_instructions_sent) == 1
         assert len(outbox) == 1
         assert response.status_code == 200
-        token = requests[0]["token"]
+        token = requests[-1]["token"]
 
         # Test invalid email
         response = client.post(
@@ -190,7 +165,6 @@ def test_recoverable_json(app, client, get_message, outbox):
         response = client.post(
             "/reset/" + token,
             json=dict(password="newpassword"),
-            headers={"Content-Type": "application/json"},
         )
         assert response.status_code == 400
         assert response.json["response"]["errors"][0].encode("utf-8") == get_message(
@@ -212,7 +186,6 @@ def test_recoverable_json(app, client, get_message, outbox):
         response = client.post(
             "/login?include_auth_token",
             json=dict(email="joe@lp.com", password="awesome sunset"),
-            headers={"Content-Type": "application/json"},
         )
         assert all(
             k in response.json["response"]["user"]
@@ -225,7 +198,6 @@ def test_recoverable_json(app, client, get_message, outbox):
         response = client.post(
             "/reset/" + token,
             json=dict(password="newpassword", password_confirm="newpassword"),
-            headers={"Content-Type": "application/json"},
         )
         assert response.status_code == 400
         assert len(recorded_resets) == 1
@@ -234,7 +206,6 @@ def test_recoverable_json(app, client, get_message, outbox):
         response = client.post(
             "/reset/bogus",
             json=dict(password="newpassword", password_confirm="newpassword"),
-            headers={"Content-Type": "application/json"},
         )
         assert response.json["response"]["errors"][0].encode("utf-8") == get_message(
             "INVALID_RESET_PASSWORD_TOKEN"
@@ -247,11 +218,9 @@ def test_recoverable_template(app, client, get_message, outbox):
     # in order to check all context vars since the default template
     # doesn't have all of them.
     with capture_reset_password_requests() as resets:
-        response = client.post(
-            "/reset", data=dict(email="joe@lp.com"), follow_redirects=True
-        )
+        response = client.post("/reset", data=dict(email="joe@lp.com"))
         assert len(outbox) == 1
-        matcher = re.findall(r"\w+:.*", outbox[0].body, re.IGNORECASE)
+        matcher = _KV_RE.findall(outbox[0].body)
         # should be 4 - link, email, token, config item
         assert matcher[1].split(":")[1] == "joe@lp.com"
         assert matcher[2].split(":")[1] == resets[0]["reset_token"]
@@ -260,19 +229,21 @@ def test_recoverable_template(app, client, get_message, outbox):
 
         # check link
         link = matcher[0].split(":", 1)[1]
-        response = client.get(link, follow_redirects=True)
+        response = client.get(link)
         assert b"Reset Password" in response.data
 
 
 def test_recover_invalidates_session(app, client):
     # Make sure that if we reset our password - prior sessions are invalidated.
-
-    other_client = app.test_client()
-    authenticate(other_client)
-    response = other_client.get("/profile", follow_redirects=True)
+    authenticate(client)
+    response = client.get("/profile")
     assert b"Profile Page" in response.data
+    # Snapshot the logged in session (and remember) cookies.
+    old_cookies = {
+        name: client.get_cookie(name).value for name in ["session", "remember_token"]
+    }
 
-    # use normal client to reset password
+    # reset password
     with capture_reset_password_requests() as requests:
         response = client.post(
             "/reset",
@@ -291,79 +262,72 @@ def test_recover_invalidates_session(app, client):
     assert response.status_code == 200
 
     # try to access protected endpoint with old session - shouldn't work
-    response = other_client.get("/profile")
+    for name, value in old_cookies.items():
+        client.set_cookie(name, value)
+    response = client.get("/profile")
     assert response.status_code == 302
     assert response.location == "/login?next=/profile"
 
 
-def test_login_form_description(app, sqlalchemy_datastore):
-    app.security = Security(app, datastore=sqlalchemy_datastore)
-    with app.test_request_context("/login"):
+def test_login_form_description(in_app_context):
+    with in_app_context.test_request_context("/login"):
         login_form = LoginForm()
         expected = '<a href="/reset">Forgot password?</a>'
         assert login_form.password.description == expected
 
 
 @pytest.mark.settings(reset_password_within="1 milliseconds")
-def test_expired_reset_token(client, get_message):
-    # Note that we need relatively new-ish date since session cookies also expire.
-    with freeze_time(date.today() + timedelta(days=-1)):
+def test_expired_reset_token(app, client, get_message, monkeypatch):
+    # Back-date just the token signing timestamp (rather than freezing all of
+    # datetime/time) - and only by a day since session cookies also expire.
+    with monkeypatch.context() as m:
+        m.setattr(TimestampSigner, "get_timestamp", _yesterday_timestamp)
         with capture_reset_password_requests() as requests:
-            client.post("/reset", data=dict(email="joe@lp.com"), follow_redirects=True)
+            client.post("/reset", data=dict(email="joe@lp.com"))
 
     user = requests[0]["user"]
     token = requests[0]["token"]
 
+    msg = get_message(
+        "PASSWORD_RESET_EXPIRED", within="1 milliseconds", email=user.email
+    ).decode("utf-8")
     with capture_flashes() as flashes:
-        msg = get_message(
-            "PASSWORD_RESET_EXPIRED", within="1 milliseconds", email=user.email
-        )
-
         # Test getting reset form with expired token
-        response = client.get("/reset/" + token, follow_redirects=True)
-        assert msg in response.data
+        response = client.get("/reset/" + token)
+        assert check_location(app, response.location, "/reset")
 
         # Test trying to reset password with expired token
         response = client.post(
             "/reset/" + token,
             data={"password": "newpassword", "password_confirm": "newpassword"},
-            follow_redirects=True,
         )
-
-        assert msg in response.data
+        assert check_location(app, response.location, "/reset")
     assert len(flashes) == 2
+    assert all(f["message"] == msg for f in flashes)
 
 
-def test_bad_reset_token(client, get_message):
-    # Test invalid token - get form
-    response = client.get("/reset/bogus", follow_redirects=True)
-    assert get_message("INVALID_RESET_PASSWORD_TOKEN") in response.data
+@pytest.mark.parametrize("token", ["bogus", _MANGLED_TOKEN], ids=["bogus", "mangled"])
+def test_bad_reset_token(app, client, get_message, token):
+    msg = get_message("INVALID_RESET_PASSWORD_TOKEN").decode("utf-8")
 
-    # Test invalid token - reset password
-    response = client.post(
-        "/reset/bogus",
-        data={"password": "newpassword", "password_confirm": "newpassword"},
-        follow_redirects=True,
-    )
-    assert get_message("INVALID_RESET_PASSWORD_TOKEN") in response.data
+    with capture_flashes() as flashes:
+        # Test invalid token - get form
+        response = client.get("/reset/" + token)
+        assert check_location(app, response.location, "/reset")
 
-    # Test mangled token
-    token = (
-        "WyIxNjQ2MzYiLCIxMzQ1YzBlZmVhM2VhZjYwODgwMDhhZGU2YzU0MzZjMiJd."
-        "BZEw_Q.lQyo3npdPZtcJ_sNHVHP103syjM"
-        "&url_id=fbb89a8328e58c181ea7d064c2987874bc54a23d"
-    )
-    response = client.post(
-        "/reset/" + token,
-        data={"password": "newpassword", "password_confirm": "newpassword"},
-        follow_redirects=True,
-    )
-    assert get_message("INVALID_RESET_PASSWORD_TOKEN") in response.data
+        # Test invalid token - reset password
+        response = client.post(
+            "/reset/" + token,
+            data={"password": "newpassword", "password_confirm": "newpassword"},
+        )
+        assert check_location(app, response.location, "/reset")
+    assert len(flashes) == 2
+    assert all(f["message"] == msg for f in flashes)
 
 
 def test_reset_token_deleted_user(app, client, get_message):
     with capture_reset_password_requests() as requests:
-        client.post("/reset", data=dict(email="gene@lp.com"), follow_redirects=True)
+        client.post("/reset", data=dict(email="gene@lp.com"))
 
     token = requests[0]["token"]
 
@@ -374,79 +338,79 @@ def test_reset_token_deleted_user(app, client, get_message):
         app.security.datastore.delete(user)
         app.security.datastore.commit()
 
-    response = client.post(
-        "/reset/" + token,
-        data={"password": "newpassword", "password_confirm": "newpassword"},
-        follow_redirects=True,
-    )
-
-    msg = get_message("INVALID_RESET_PASSWORD_TOKEN")
-    assert msg in response.data
+    with capture_flashes() as flashes:
+        response = client.post(
+            "/reset/" + token,
+            data={"password": "newpassword", "password_confirm": "newpassword"},
+        )
+    assert check_location(app, response.location, "/reset")
+    msg = get_message("INVALID_RESET_PASSWORD_TOKEN").decode("utf-8")
+    assert flashes[0]["message"] == msg
 
 
-def test_used_reset_token(client, get_message):
+def test_used_reset_token(app, client, get_message):
     with capture_reset_password_requests() as requests:
-        client.post("/reset", data=dict(email="joe@lp.com"), follow_redirects=True)
+        client.post("/reset", data=dict(email="joe@lp.com"))
 
     token = requests[0]["token"]
 
     # use the token
-    response = client.post(
-        "/reset/" + token,
-        data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
-        follow_redirects=True,
-    )
-
-    assert get_message("PASSWORD_RESET_NO_LOGIN") in response.data
+    with capture_flashes() as flashes:
+        response = client.post(
+            "/reset/" + token,
+            data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
+        )
+    assert response.status_code == 302
+    assert check_location(app, response.location, "/login")
+    msg = get_message("PASSWORD_RESET_NO_LOGIN").decode("utf-8")
+    assert flashes[0]["message"] == msg
 
     logout(client)
 
     # attempt to use it a second time
-    response2 = client.post(
-        "/reset/" + token,
-        data={"password": "otherpassword", "password_confirm": "otherpassword"},
-        follow_redirects=True,
-    )
-
-    msg = get_message("INVALID_RESET_PASSWORD_TOKEN")
-    assert msg in response2.data
+    with capture_flashes() as flashes:
+        response2 = client.post(
+            "/reset/" + token,
+            data={"password": "otherpassword", "password_confirm": "otherpassword"},
+        )
+    assert check_location(app, response2.location, "/reset")
+    msg = get_message("INVALID_RESET_PASSWORD_TOKEN").decode("utf-8")
+    assert flashes[0]["message"] == msg
 
 
-def test_reset_passwordless_user(client, get_message):
+def test_reset_passwordless_user(app, client, get_message):
     with capture_reset_password_requests() as requests:
-        client.post("/reset", data=dict(email="jess@lp.com"), follow_redirects=True)
+        client.post("/reset", data=dict(email="jess@lp.com"))
 
     token = requests[0]["token"]
 
     # use the token
-    response = client.post(
-        "/reset/" + token,
-        data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
-        follow_redirects=True,
-    )
-
-    assert get_message("PASSWORD_RESET_NO_LOGIN") in response.data
-
-
-@pytest.mark.settings(reset_url="/custom_reset")
-def test_custom_reset_url(client):
-    response = client.get("/custom_reset")
-    assert response.status_code == 200
+    with capture_flashes() as flashes:
+        response = client.post(
+            "/reset/" + token,
+            data={"password": "awesome sunset", "password_confirm": "awesome sunset"},
+        )
+    assert response.status_code == 302
+    assert check_location(app, response.location, "/login")
+    msg = get_message("PASSWORD_RESET_NO_LOGIN").decode("utf-8")
+    assert flashes[0]["message"] == msg
 
 
 @pytest.mark.settings(
+    reset_url="/custom_reset",
     reset_password_template="custom_security/reset_password.html",
     forgot_password_template="custom_security/forgot_password.html",
 )
-def test_custom_reset_templates(client):
+def test_custom_reset_url_and_templates(client, joe_reset_token):
     response = client.get("/reset")
-    assert b"CUSTOM FORGOT PASSWORD" in response.data
+    assert response.status_code == 404
 
-    with capture_reset_password_requests() as requests:
-        client.post("/reset", data=dict(email="joe@lp.com"), follow_redirects=True)
-        token = requests[0]["token"]
+    response = client.get("/custom_reset")
+    assert response.status_code == 200
+    assert b"CUSTOM FORGOT PASSWORD" in response.data
 
-    response = client.get("/reset/" + token)
+    _, token = joe_reset_token
+    response = client.get("/custom_reset/" + token)
     assert b"CUSTOM RESET PASSWORD" in response.data
 
 
@@ -471,10 +435,9 @@ def test_spa_get(app, client):
 
     response = client.get("/reset/" + token)
     assert response.status_code == 302
-    split = urlsplit(response.headers["Location"])
-    assert "myui.com:8090" == split.netloc
-    assert "/reset-redirect" == split.path
-    qparams = dict(parse_qsl(split.query))
+    host, path, qparams = _split_spa_location(response.headers["Location"])
+    assert "myui.com:8090" == host
+    assert "/reset-redirect" == path
     # we shouldn't be showing PII
     assert "email" not in qparams
     assert qparams["token"] == token
@@ -486,16 +449,15 @@ def test_spa_get(app, client):
     redirect_behavior="spa",
     reset_error_view="/reset-error",
 )
-def test_spa_get_bad_token(app, client, get_message):
+def test_spa_get_bad_token(app, client, get_message, monkeypatch):
     """Test expired and invalid token"""
     with capture_flashes() as flashes:
-        # Note that we need relatively new-ish date since session cookies also expire.
-        with freeze_time(date.today() + timedelta(days=-1)):
+        with monkeypatch.context() as m:
+            m.setattr(TimestampSigner, "get_timestamp", _yesterday_timestamp)
             with capture_reset_password_requests() as requests:
                 response = client.post(
                     "/reset",
                     json=dict(email="joe@lp.com"),
-                    headers={"Content-Type": "application/json"},
                 )
                 assert response.headers["Content-Type"] == "application/json"
                 assert "user" not in response.json["response"]
@@ -503,10 +465,9 @@ def test_spa_get_bad_token(app, client, get_message):
 
         response = client.get("/reset/" + token)
         assert response.status_code == 302
-        split = urlsplit(response.headers["Location"])
-        assert "localhost:8081" == split.netloc
-        assert "/reset-error" == split.path
-        qparams = dict(parse_qsl(split.query))
+        host, path, qparams = _split_spa_location(response.headers["Location"])
+        assert "localhost:8081" == host
+        assert "/reset-error" == path
         # on error - no PII should be returned.
         assert "error" in qparams
         assert "identity" not in qparams
@@ -514,64 +475,57 @@ def test_spa_get_bad_token(app, client, get_message):
 
         msg = get_message(
             "PASSWORD_RESET_EXPIRED", within="1 milliseconds", email="joe@lp.com"
-        )
-        assert msg == qparams["error"].encode("utf-8")
+        ).decode("utf-8")
+        assert msg == qparams["error"]
 
         # Test mangled token
-        token = (
-            "WyIxNjQ2MzYiLCIxMzQ1YzBlZmVhM2VhZjYwODgwMDhhZGU2YzU0MzZjMiJd."
-            "BZEw_Q.lQyo3npdPZtcJ_sNHVHP103syjM"
-            "&url_id=fbb89a8328e58c181ea7d064c2987874bc54a23d"
-        )
-        response = client.get("/reset/" + token)
+        response = client.get("/reset/" + _MANGLED_TOKEN)
         assert response.status_code == 302
-        split = urlsplit(response.headers["Location"])
-        assert "localhost:8081" == split.netloc
-        assert "/reset-error" == split.path
-        qparams = dict(parse_qsl(split.query))
+        host, path, qparams = _split_spa_location(response.headers["Location"])
+        assert "localhost:8081" == host
+        assert "/reset-error" == path
         assert len(qparams) == 1
         assert all(k in qparams for k in ["error"])
 
-        msg = get_message("INVALID_RESET_PASSWORD_TOKEN")
-        assert msg == qparams["error"].encode("utf-8")
+        msg = get_message("INVALID_RESET_PASSWORD_TOKEN").decode("utf-8")
+        assert msg == qparams["error"]
     assert len(flashes) == 0
 
 
 @pytest.mark.settings(password_complexity_checker="zxcvbn")
-def test_easy_password(client, get_message):
-    with capture_reset_password_requests() as requests:
-        client.post("/reset", data=dict(email="joe@lp.com"), follow_redirects=True)
-
-    token = requests[0]["token"]
+def test_easy_password(client, get_message, joe_reset_token, monkeypatch):
+    # We are testing that checker errors are surfaced - not zxcvbn itself
+    # (test_registerable/test_changeable exercise the real thing).
+    monkeypatch.setattr(
+        "zxcvbn.zxcvbn",
+        lambda password, user_inputs=None: dict(
+            score=0, feedback=dict(warning="Checker says no")
+        ),
+    )
+    _, token = joe_reset_token
 
     # use the token
     response = client.post(
         "/reset/" + token,
         data={"password": "mypassword", "password_confirm": "mypassword"},
-        follow_redirects=True,
     )
 
-    assert b"This is a very common password" in response.data
+    assert b"Checker says no" in response.data
 
 
 def test_reset_inactive(client, get_message):
-    response = client.post(
-        "/reset", data=dict(email="tiya@lp.com"), follow_redirects=True
-    )
+    response = client.post("/reset", data=dict(email="tiya@lp.com"))
     assert get_message("DISABLED_ACCOUNT") in response.data
 
     response = client.post(
         "/reset",
         json=dict(email="tiya@lp.com"),
-        headers={"Content-Type": "application/json"},
     )
     assert response.status_code == 400
 
 
 def test_email_normalization(client, get_message):
-    response = client.post(
-        "/reset", data=dict(email="joe@LP.COM"), follow_redirects=True
-    )
+    response = client.post("/reset", data=dict(email="joe@LP.COM"))
     assert response.status_code == 200
     assert get_message("PASSWORD_RESET_REQUEST", email="joe@lp.com") in response.data
 
@@ -623,24 +577,24 @@ def test_generic_response(app, client, get_message):
 
     response = client.post("/reset", json=dict(email="whoami@test.com"))
     assert response.status_code == 200
-    assert not any(e in response.json["response"].keys() for e in ["error", "errors"])
+    jresponse = response.json["response"]
+    assert "error" not in jresponse and "errors" not in jresponse
 
 
+@pytest.mark.settings(
+    return_generic_responses=True, forgot_password_template="generic_reset.html"
+)
 def test_generic_with_extra(app, sqlalchemy_datastore):
     # If application adds a field, make sure we properly return errors
     # even if 'RETURN_GENERIC_RESPONSES' is set.
     class MyForgotPasswordForm(ForgotPasswordForm):
         recaptcha = StringField("Recaptcha", validators=[Length(min=5)])
 
-    app.config["SECURITY_RETURN_GENERIC_RESPONSES"] = True
-    app.config["SECURITY_FORGOT_PASSWORD_TEMPLATE"] = "generic_reset.html"
-    app.security = Security(
+    init_app_with_options(
         app,
-        datastore=sqlalchemy_datastore,
-        forgot_password_form=MyForgotPasswordForm,
+        sqlalchemy_datastore,
+        security_args=dict(forgot_password_form=MyForgotPasswordForm),
     )
-
-    populate_data(app)
     client = app.test_client()
 
     # Test valid user but invalid additional form field
@@ -689,54 +643,33 @@ def test_generic_with_extra(app, sqlalchemy_datastore):
 
 @pytest.mark.filterwarnings("ignore")
 @pytest.mark.settings(auto_login_after_reset=True, post_reset_view="/post_reset")
-def test_auto_login(client, get_message):
+@pytest.mark.parametrize("mode", ["form", "json"])
+def test_auto_login(app, client, get_message, mode):
     # test backwards compat flag (not OWASP recommended)
     with capture_reset_password_requests() as requests:
-        response = client.post(
-            "/reset", data=dict(email="joe@lp.com"), follow_redirects=True
-        )
+        if mode == "json":
+            response = client.post("/reset", json=dict(email="joe@lp.com"))
+            assert response.headers["Content-Type"] == "application/json"
+        else:
+            response = client.post("/reset", data=dict(email="joe@lp.com"))
     assert response.status_code == 200
     token = requests[0]["token"]
 
     # Test submitting a new password
-    with capture_flashes() as flashes:
-        response = client.post(
-            "/reset/" + token,
-            data=dict(password="awesome sunset", password_confirm="awesome sunset"),
-            follow_redirects=True,
-        )
-        assert b"Post Reset" in response.data
-    assert len(flashes) == 1
-    assert get_message("PASSWORD_RESET") == flashes[0]["message"].encode("utf-8")
-
-    # verify actually logged in
-    response = client.get("/profile", follow_redirects=False)
-    assert response.status_code == 200
-
-
-@pytest.mark.filterwarnings("ignore")
-@pytest.mark.settings(auto_login_after_reset=True)
-def test_auto_login_json(client, get_message):
-    # test backwards compat flag (not OWASP recommended)
-    with capture_reset_password_requests() as requests:
-        response = client.post(
-            "/reset",
-            json=dict(email="joe@lp.com"),
+    data = dict(password="awesome sunset", password_confirm="awesome sunset")
+    if mode == "json":
+        response = client.post("/reset/" + token + "?include_auth_token", json=data)
+        assert all(
+            k in response.json["response"]["user"]
+            for k in ["email", "authentication_token"]
         )
-        assert response.headers["Content-Type"] == "application/json"
-
-    assert response.status_code == 200
-    token = requests[0]["token"]
+    else:
+        with capture_flashes() as flashes:
+            response = client.post("/reset/" + token, data=data)
+            assert check_location(app, response.location, "/post_reset")
+        assert len(flashes) == 1
+        assert flashes[0]["message"] == get_message("PASSWORD_RESET").decode("utf-8")
 
-    # Test submitting a new password
-    response = client.post(
-        "/reset/" + token + "?include_auth_token",
-        json=dict(password="awesome sunset", password_confirm="awesome sunset"),
-    )
-    assert all(
-        k in response.json["response"]["user"]
-        for k in ["email", "authentication_token"]
-    )
     # verify actually logged in
     response = client.get("/profile", follow_redirects=False)
     assert response.status_code == 200
@@ -761,7 +694,6 @@ def test_recoverable_json_async(app, client, get_message):
         response = client.post(
             "/reset",
             json=dict(email="joe@lp.com"),
-            headers={"Content-Type": "application/json"},
         )
 
     assert len(recorded_instructions_sent) == 1
@@ -780,13 +712,17 @@ def test_recoverable_json_async(app, client, get_message):
 @pytest.mark.csrf()
 @pytest.mark.settings(post_reset_view="/post_reset_view")
 def test_csrf(app, client, get_message):
-    response = client.get("/reset")
-    csrf_token = get_form_input_value(response, "csrf_token")
+    # Generate a CSRF token directly (rather than rendering and parsing /reset)
+    # and seed the client's session with the matching raw token.
+    with app.test_request_context():
+        csrf_token = generate_csrf()
+        raw_token = session["csrf_token"]
+    with client.session_transaction() as sess:
+        sess["csrf_token"] = raw_token
     with capture_reset_password_requests() as requests:
         client.post(
             "/reset",
             data=dict(email="joe@lp.com", csrf_token=csrf_token),
-            follow_redirects=True,
         )
     token = requests[0]["token"]
 
@@ -815,7 +751,6 @@ def test_auth_csrf(app, client, get_message):
         client.post(
             "/reset",
             data=dict(email="matt@lp.com", csrf_token=csrf_token),
-            follow_redirects=True,
         )
     token = requests[0]["token"]
 
@@ -833,31 +768,20 @@ def test_auth_csrf(app, client, get_message):
     assert not is_authenticated(client, get_message)
 
 
-def test_recoverable_auth_json(app, client, get_message, outbox):
-    recorded_resets = []
-    recorded_instructions_sent = []
-
-    @password_reset.connect_via(app)
-    def on_password_reset(app, user):
-        recorded_resets.append(user)
-
-    @reset_password_instructions_sent.connect_via(app)
-    def on_instructions_sent(app, **kwargs):
-        recorded_instructions_sent.append(kwargs["user"])
+def test_recoverable_auth_json(app, client, get_message, outbox, reset_signal_recorder):
+    recorded_resets, recorded_instructions_sent = reset_signal_recorder
 
     authenticate(client, "joe@lp.com", password="password")
-    with capture_flashes() as flashes:
+    with capture_flashes() as flashes, capture_reset_password_requests() as requests:
         # Test reset password creates a token and sends email
-        with capture_reset_password_requests() as requests:
-            response = client.post(
-                "/reset",
-                json=dict(email="joe@lp.com"),
-            )
-
+        response = client.post(
+            "/reset",
+            json=dict(email="joe@lp.com"),
+        )
         assert len(recorded_instructions_sent) == 1
         assert len(outbox) == 1
         assert response.status_code == 200
-        token = requests[0]["token"]
+        token = requests[-1]["token"]
 
         # Test invalid email
         response = client.post(
@@ -893,7 +817,6 @@ def test_recoverable_auth_json(app, client, get_message, outbox):
         response = client.post(
             "/reset/" + token,
             json=dict(password="newpassword", password_confirm="newpassword"),
-            headers={"Content-Type": "application/json"},
         )
         assert response.status_code == 400
         assert len(recorded_resets) == 1
@@ -902,7 +825,6 @@ def test_recoverable_auth_json(app, client, get_message, outbox):
         response = client.post(
             "/reset/bogus",
             json=dict(password="newpassword", password_confirm="newpassword"),
-            headers={"Content-Type": "application/json"},
         )
         assert response.json["response"]["errors"][0].encode("utf-8") == get_message(
             "INVALID_RESET_PASSWORD_TOKEN"
@@ -912,36 +834,21 @@ def test_recoverable_auth_json(app, client, get_message, outbox):
 
 @pytest.mark.username_recovery()
 def test_username_recovery_valid_email(app, clients, get_message, outbox):
-    recorded_recovery_sent = []
-
-    @username_recovery_email_sent.connect_via(app)
-    def on_email_sent(app, **kwargs):
-        assert isinstance(app, Flask)
-        assert isinstance(kwargs["user"], UserMixin)
-        recorded_recovery_sent.append(kwargs["user"])
-
     # Test the username recovery view
     response = clients.get("/recover-username")
     assert b"<h1>Username Recovery</h1>" in response.data
 
-    response = clients.post(
-        "/recover-username", data=dict(email="joe@lp.com"), follow_redirects=True
-    )
-
-    assert len(recorded_recovery_sent) == 1
-    assert len(outbox) == 1
-    assert response.status_code == 200
-
     with capture_flashes() as flashes:
-        response = clients.post(
-            "/recover-username",
-            data=dict(email="joe@lp.com"),
-            follow_redirects=True,
-        )
-    assert len(flashes) == 1
-    assert get_message("USERNAME_RECOVERY_REQUEST") == flashes[0]["message"].encode(
-        "utf-8"
-    )
+        with capture_username_recovery_requests() as recovered:
+            response = clients.post("/recover-username", data=dict(email="joe@lp.com"))
+        assert len(recovered) == 1
+        assert isinstance(recovered[0]["user"], UserMixin)
+        assert len(outbox) == 1
+        assert check_location(app, response.location, "/login")
+
+        response = clients.post("/recover-username", data=dict(email="joe@lp.com"))
+    msg = get_message("USERNAME_RECOVERY_REQUEST").decode("utf-8")
+    assert [flash["message"] for flash in flashes] == [msg, msg]
 
     # Validate the emailed username
     email = outbox[1]
@@ -951,7 +858,6 @@ def test_username_recovery_valid_email(app, clients, get_message, outbox):
     response = clients.post(
         "/recover-username",
         json=dict(email="joe@lp.com"),
-        headers={"Content-Type": "application/json"},
     )
     assert response.status_code == 200
     assert response.headers["Content-Type"] == "application/json"
@@ -959,9 +865,7 @@ def test_username_recovery_valid_email(app, clients, get_message, outbox):
 
 @pytest.mark.username_recovery()
 def test_username_recovery_invalid_email(app, clients, outbox):
-    response = clients.post(
-        "/recover-username", data=dict(email="bogus@lp.com"), follow_redirects=True
-    )
+    response = clients.post("/recover-username", data=dict(email="bogus@lp.com"))
 
     assert len(outbox) == 0
     assert response.status_code == 200
@@ -970,7 +874,6 @@ def test_username_recovery_invalid_email(app, clients, outbox):
     response = clients.post(
         "/recover-username",
         json=dict(email="bogus@lp.com"),
-        headers={"Content-Type": "application/json"},
     )
     assert response.status_code == 400
     assert response.headers["Content-Type"] == "application/json"
@@ -983,59 +886,37 @@ def test_username_recovery_invalid_email(app, clients, outbox):
 
 @pytest.mark.username_recovery()
 @pytest.mark.settings(return_generic_responses=True)
-def test_username_recovery_generic_responses(app, clients, get_message, outbox):
-    recorded_recovery_sent = []
-
-    @username_recovery_email_sent.connect_via(app)
-    def on_email_sent(app, **kwargs):
-        recorded_recovery_sent.append(kwargs["user"])
-
-    # Test with valid email
-    with capture_flashes() as flashes:
-        response = clients.post(
-            "/recover-username",
-            data=dict(email="joe@lp.com"),
-            follow_redirects=True,
-        )
-    assert len(flashes) == 1
-    assert get_message("USERNAME_RECOVERY_REQUEST") == flashes[0]["message"].encode(
-        "utf-8"
-    )
-    assert len(recorded_recovery_sent) == 1
-    assert len(outbox) == 1
-    assert response.status_code == 200
-
-    # Test with non-existant email (should still return 200)
-    with capture_flashes() as flashes:
-        response = clients.post(
-            "/recover-username",
-            data=dict(email="bogus@lp.com"),
-            follow_redirects=True,
-        )
-    assert len(flashes) == 1
-    assert get_message("USERNAME_RECOVERY_REQUEST") == flashes[0]["message"].encode(
-        "utf-8"
-    )
-    # Validate no email was sent (there should only be one from the previous test)
-    assert len(recorded_recovery_sent) == 1
-    assert len(outbox) == 1
-    assert response.status_code == 200
-
-    # Test JSON responses - valid email
-    response = clients.post(
-        "/recover-username",
-        json=dict(email="joe@lp.com"),
-        headers={"Content-Type": "application/json"},
-    )
-    assert response.status_code == 200
-    assert response.headers["Content-Type"] == "application/json"
-
-    # Test JSON responses - invalid email
-    response = clients.post(
-        "/recover-username",
-        json=dict(email="bogus@lp.com"),
-        headers={"Content-Type": "application/json"},
-    )
-    assert response.status_code == 200
-    assert response.headers["Content-Type"] == "application/json"
-    assert not any(e in response.json["response"].keys() for e in ["error", "errors"])
+@pytest.mark.parametrize("email, expect_mail", [("joe@lp.com", 1), ("bogus@lp.com", 0)])
+@pytest.mark.parametrize("mode", ["form", "json"])
+def test_username_recovery_generic_responses(
+    app, client, get_message, outbox, mode, email, expect_mail
+):
+    # Neither an unknown email nor a known one reports an error, and both get the
+    # same USERNAME_RECOVERY_REQUEST message. JSON responses are identical, but
+    # the form path redirects to login for a known email and re-renders the
+    # form for an unknown one.
+    with capture_username_recovery_requests() as recovered:
+        if mode == "json":
+            response = client.post("/recover-username", json=dict(email=email))
+        else:
+            response = client.post("/recover-username", data=dict(email=email))
+    assert len(recovered) == expect_mail
+    assert len(outbox) == expect_mail
+
+    if mode == "json":
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/json"
+        jresponse = response.json["response"]
+        assert "error" not in jresponse and "errors" not in jresponse
+        assert read_flashes(client) == []
+    elif expect_mail:
+        # Redirect not followed - the flash is still pending in the session.
+        assert response.status_code == 302
+        assert check_location(app, response.location, "/login")
+        assert [f["message"] for f in read_flashes(client)] == [
+            get_message("USERNAME_RECOVERY_REQUEST").decode("utf-8")
+        ]
+    else:
+        assert response.status_code == 200
+        assert get_message("USERNAME_RECOVERY_REQUEST") in response.data
+        assert read_flashes(client) == []
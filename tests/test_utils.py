@@ -269,13 +269,16 @@ def create_users(app, ds, count=None):
         ("gal3@lp.com", "gal3", "password", ["admin"], True, 331122, "email"),
     ]
     count = count or len(users)
+    # Most users share the same password - only hash each distinct one once.
+    hashes: dict[str, str] = {}
 
     for u in users[:count]:
         pw = u[2]
         if pw is not None:
-            pw = hash_password(pw)
+            if pw not in hashes:
+                hashes[pw] = hash_password(pw)
+            pw = hashes[pw]
         roles = [ds.find_or_create_role(rn) for rn in u[3]]
-        ds.commit()
         totp_secret = None
         if app.config.get("SECURITY_TWO_FACTOR", None) and u[6]:
             totp_secret = app.security._totp_factory.generate_totp_secret()
@@ -288,9 +291,9 @@ def create_users(app, ds, count=None):
             tf_primary_method=u[6],
             tf_totp_secret=totp_secret,
         )
-        ds.commit()
         for role in roles:
             ds.add_role_to_user(user, role)
+        # A single commit per user - roles were already committed by create_roles().
         ds.commit()
 
 
@@ -430,6 +433,16 @@ def capture_flashes():
         message_flashed.disconnect(_on)
 
 
+def read_flashes(client):
+    """Pop flashes still pending in the client's session.
+
+    Only useful when the response didn't render them - e.g. a redirect that
+    wasn't followed. Returns the same dicts as capture_flashes().
+    """
+    with client.session_transaction() as sess:
+        return [dict(category=c, message=m) for c, m in sess.pop("_flashes", [])]
+
+
 @contextmanager
 def capture_send_code_requests():
     # Easy way to get token/code required for code logins